@@ -198,8 +198,16 @@ class Builder(LoggingConfigurable):
                 for i in range(next_event, len_events):
                     event = event_queue[i]
 
-                    yield event 
-                
+                    # Coalesce runs of pending events at the same progress
+                    # value - only the newest of each run is yielded, so a
+                    # burst of updates at one stage becomes one SSE write
+                    if i + 1 < len_events:
+                        progress_val = event.get('progress')
+                        if progress_val is not None and event_queue[i + 1].get('progress') == progress_val:
+                            continue
+
+                    yield event
+
                 next_event = len_events
 
             if break_while_loop:
@@ -1,17 +1,27 @@
+import asyncio
+import atexit
+import itertools
+import os
 import sys
-from concurrent.futures import ThreadPoolExecutor
-import functools
+import time
+from collections import OrderedDict
+from datetime import datetime
 
-import docker
-from docker.utils import kwargs_from_env
-from traitlets import Dict, Unicode, Any
-from tornado import ioloop
+import aiodocker
+import aiohttp
+from traitlets import Dict, Unicode, Integer, Any
 from tornado.log import app_log
 from .builders import BuildException
 from .processbuilder import ProcessBuilder
 from .. import hookimpl
 from ..pluggymanager import pm
 
+# Image tags combine the process start time with a monotonic counter: strftime
+# only has 1s resolution, so two builds of the same dashboard in the same
+# second would otherwise produce colliding tags
+_TAG_EPOCH = datetime.utcnow().strftime('%Y%m%d-%H%M%S')
+_tag_counter = itertools.count()
+
 
 class BasicDockerBuilder(ProcessBuilder):
 
@@ -19,57 +29,100 @@ class BasicDockerBuilder(ProcessBuilder):
 
     @property
     def client(self):
-        """single global client instance"""
+        """single global aiodocker client instance
+
+        One aiohttp session (and so one keep-alive connection pool to the
+        Docker daemon) is shared by all builders in the process, so concurrent
+        builds no longer queue behind each other on a single worker thread.
+        """
         cls = self.__class__
-        if cls._client is None:
-            kwargs = {"version": "auto"}
-            if self.tls_config:
-                kwargs["tls"] = docker.tls.TLSConfig(**self.tls_config)
-            kwargs.update(kwargs_from_env())
-            kwargs.update(self.client_kwargs)
-            client = docker.APIClient(**kwargs)
-            cls._client = client
+        if cls._client is None or cls._client.session.closed:
+            kwargs = dict(self.client_kwargs)
+            url = kwargs.get('url') or os.environ.get('DOCKER_HOST', '')
+            if 'connector' not in kwargs and 'session' not in kwargs \
+                    and url.startswith(('tcp://', 'http://', 'https://')):
+                # Remote daemon: pool generously and keep idle sockets open
+                # well beyond aiohttp's default, so successive calls within a
+                # build (and successive builds) reuse the same TCP/TLS session.
+                # aiodocker only rewrites tcp:// urls and applies TLS when
+                # building its own connector, so with a custom connector both
+                # have to be handled here
+                ssl_context = kwargs.pop('ssl_context', None)
+                if ssl_context is None and os.environ.get('DOCKER_TLS_VERIFY'):
+                    # the same env-based (docker-machine style) TLS setup
+                    # aiodocker would apply with its default connector
+                    ssl_context = aiodocker.Docker._docker_machine_ssl_context()
+                if url.startswith('tcp://'):
+                    url = url.replace('tcp://', 'https://' if ssl_context else 'http://', 1)
+                kwargs['url'] = url
+                connector_kwargs = dict(
+                    limit=100, limit_per_host=32, keepalive_timeout=75, enable_cleanup_closed=True
+                )
+                if ssl_context is not None:
+                    connector_kwargs['ssl'] = ssl_context
+                kwargs['connector'] = aiohttp.TCPConnector(**connector_kwargs)
+            cls._client = aiodocker.Docker(**kwargs)
+            if not cls._atexit_registered:
+                # the hub offers no shutdown hook to a config-only extension,
+                # so close the shared session at interpreter exit instead
+                atexit.register(cls._shutdown_at_exit)
+                cls._atexit_registered = True
         return cls._client
 
-    tls_config = Dict(
-        config=True,
-        help="""Arguments to pass to docker TLS configuration.
-        See docker.client.TLSConfig constructor for options.
-        """,
-    )
-
     client_kwargs = Dict(
         config=True,
-        help="Extra keyword arguments to pass to the docker.Client constructor.",
+        help="Extra keyword arguments to pass to the aiodocker.Docker constructor, e.g. url or ssl_context.",
     )
 
     _client = None
+    _atexit_registered = False
 
-    def _docker(self, method, *args, **kwargs):
-        """wrapper for calling docker methods
-        to be passed to ThreadPoolExecutor
-        """
-        m = getattr(self.client, method)
-        return m(*args, **kwargs)
+    @classmethod
+    def _shutdown_at_exit(cls):
+        """atexit hook: close the shared client so the aiohttp session does
+        not leak (with an 'Unclosed client session' warning) at hub exit
 
-    def docker(self, method, *args, **kwargs):
-        """Call a docker method in a background thread
-        returns a Future
+        The hub's own loop is no longer running by the time atexit hooks
+        fire, so drive the close on a throwaway loop.
+        """
+        if cls._client is None or cls._client.session.closed:
+            return
+        try:
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(cls.shutdown())
+            finally:
+                loop.close()
+        except Exception as e:
+            app_log.debug('Could not close Docker client at exit: %s', e)
+
+    @classmethod
+    async def shutdown(cls):
+        """Close the shared aiodocker client (and its aiohttp session)
+
+        Should be awaited when the hub shuts down - safe to call if no client
+        was ever created.
         """
-        fn = functools.partial(self._docker, method, *args, **kwargs)
-        return ioloop.IOLoop.current().run_in_executor(self._executor, fn)
+        if cls._client is not None:
+            await cls._client.close()
+            cls._client = None
 
-    _executor = None
+    repo_prefix = Unicode(default_value='cdsuser').tag(config=True)
 
-    @property
-    def executor(self):
-        """single global executor"""
-        cls = self.__class__
-        if cls._executor is None:
-            cls._executor = ThreadPoolExecutor(1)
-        return cls._executor
+    image_cache_ttl = Integer(
+        0,
+        help="""Seconds for which a committed dashboard image may be reused by
+        a repeat build of the same unchanged source container. Committing
+        walks the container's whole writable layer, so skipping it is usually
+        the biggest saving on a rebuild. The default of 0 always commits a
+        fresh image - set above 0 to opt into reuse.
+        """,
+    ).tag(config=True)
 
-    repo_prefix = Unicode(default_value='cdsuser').tag(config=True)
+    # Recently committed images shared across all builders in the process,
+    # keyed by source container and commit parameters, LRU-ordered
+    _image_cache = OrderedDict()
+    _image_cache_size = 32
 
     async def prespawn_server_options(self, dashboard, dashboard_user, ns):
 
@@ -78,7 +131,7 @@ class BasicDockerBuilder(ProcessBuilder):
         if source_spawner_orm is None:
             return {} # Just use default image
 
-        tag = self.format_string('{date}-{time}', ns=ns)
+        tag = '{}-{}'.format(_TAG_EPOCH, next(_tag_counter))
 
         source_spawner_name = source_spawner_orm.name
 
@@ -87,31 +140,20 @@ class BasicDockerBuilder(ProcessBuilder):
 
         source_spawner = dashboard_user.spawners[source_spawner_name]
 
-        app_log.debug('source_spawner {}'.format(source_spawner))
+        app_log.debug('source_spawner %s', source_spawner)
 
         #if source_spawner.state is None:
         #    raise BuildException('Source server has never been run, so there is nothing to clone!')
 
         object_id = source_spawner.object_id #source_spawner.state.get('object_id', None)
 
-        app_log.debug('Docker object_id is {}'.format(object_id))
+        app_log.debug('Docker object_id is %s', object_id)
 
         if object_id is None:
             raise BuildException('No docker object specified in spawner state - maybe the source server has never been run')
 
-        source_container = await self.docker('inspect_container', object_id)
-
-        if source_container is None:
-            raise BuildException('No docker object returned as source container')
-
-        # Commit image of current server
-
         reponame = '{}/{}'.format(self.repo_prefix, dashboard.urlname)
 
-        image_name = '{}:{}'.format(reponame, tag)
-
-        app_log.info('Committing Docker image {}'.format(image_name))
-
         dockerfile_changes="\n".join([
             'CMD ["{}-entrypoint.sh"]'.format(dashboard.presentation_type),
             'ENV JUPYTERHUB_GROUP {}'.format(dashboard.groupname),
@@ -119,12 +161,77 @@ class BasicDockerBuilder(ProcessBuilder):
             'ENV JUPYTERHUB_CDS_PRESENTATION_PATH "{}"'.format(dashboard.start_path or ''),
         ])
 
-        await self.docker('commit', object_id, repository=reponame, tag=tag, changes=dockerfile_changes)
+        # Reuse a recently committed image if the source container, its state
+        # and the commit parameters are all unchanged - skipping the commit
+        # saves a walk of the container's writable layer on the daemon
+        # Spawner wrappers don't expose .state directly - it lives on the ORM row
+        source_state = getattr(getattr(source_spawner, 'orm_spawner', None), 'state', None) or {}
+        cache_key = (object_id, hash(repr(sorted(source_state.items()))), dockerfile_changes)
+        cached = self._image_cache.get(cache_key)
+        if cached is not None:
+            cached_image, expiry = cached
+            reuse = False
+            if self.image_cache_ttl and expiry > time.monotonic():
+                try:
+                    # cheap existence check - the image may have been pruned
+                    # from the daemon since it was committed
+                    await self.client.images.inspect(cached_image)
+                    reuse = True
+                except aiodocker.DockerError:
+                    app_log.info('Cached Docker image %s no longer exists - committing afresh', cached_image)
+            if reuse:
+                self._image_cache.move_to_end(cache_key)
+                app_log.info('Reusing recently committed Docker image %s', cached_image)
+                self.add_progress_event({'progress': 60, 'message': 'Reusing recently built Docker image {}'.format(cached_image)})
+                return {'image': cached_image}
+            del self._image_cache[cache_key]
+
+        image_name = '{}:{}'.format(reponame, tag)
+
+        try:
+            source_container = await self.client.containers.get(object_id)
+        except aiodocker.DockerError as e:
+            raise BuildException('No docker object returned as source container: {}'.format(e))
+
+        # Commit image of current server
+
+        app_log.info('Committing Docker image %s', image_name)
+
+        await source_container.commit(repository=reponame, tag=tag, changes=dockerfile_changes)
+
+        await self._wait_for_image(image_name)
 
-        self.log.info('Finished commit of Docker image {}:{}'.format(reponame, tag))
+        self.log.info('Finished commit of Docker image %s:%s', reponame, tag)
+
+        if self.image_cache_ttl:
+            self._image_cache[cache_key] = (image_name, time.monotonic() + self.image_cache_ttl)
+            self._image_cache.move_to_end(cache_key)
+            while len(self._image_cache) > self._image_cache_size:
+                self._image_cache.popitem(last=False)
 
         return {'image': image_name}
 
+    async def _wait_for_image(self, image_name, timeout=30):
+        """Wait until the committed image is visible to the Docker daemon
+
+        Polls inspect with exponential backoff (0.1s doubling up to a 2s cap)
+        rather than sleeping for a fixed period, so the build continues as
+        soon as the image is actually available.
+        """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        delay = 0.1
+        while True:
+            try:
+                await self.client.images.inspect(image_name)
+                self.add_progress_event({'progress': 60, 'message': 'Docker image {} is ready'.format(image_name)})
+                return
+            except aiodocker.DockerError:
+                if loop.time() + delay > deadline:
+                    raise BuildException('Committed Docker image {} did not appear within {}s'.format(image_name, timeout))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2)
+
 
 DockerBuilder = BasicDockerBuilder
 # Register plugin hooks so we use the Basic handlers by default, unless overridden
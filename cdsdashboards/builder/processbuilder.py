@@ -1,10 +1,12 @@
+import asyncio
+
 from tornado.log import app_log
 
 from .builders import Builder, BuildException
 
 
 class ProcessBuilder(Builder):
- 
+
     async def start(self, dashboard, dashboard_user, db):
         """Start the dashboard
 
@@ -33,13 +35,10 @@ class ProcessBuilder(Builder):
         spawner = dashboard_user.spawners[new_server_name] # Could be orm_spawner or Spawner wrapper
 
         if spawner.ready:
-            # include notify, so that a server that died is noticed immediately
-            # set _spawn_pending flag to prevent races while we wait
-            spawner._spawn_pending = True
-            try:
-                state = await spawner.poll_and_notify()
-            finally:
-                spawner._spawn_pending = False
+            # include notify, so that a server that died is noticed immediately -
+            # but in the background, since the poll result isn't used here and
+            # the build doesn't need to wait on the liveness round-trip
+            asyncio.ensure_future(self._poll_and_notify_safely(spawner))
 
         git_repo = dashboard.options.get('git_repo', '')
         conda_env = dashboard.options.get('conda_env', '')
@@ -58,6 +57,16 @@ class ProcessBuilder(Builder):
 
         return (new_server_name, new_server_options)
 
+    @staticmethod
+    async def _poll_and_notify_safely(spawner):
+        # deliberately leaves _spawn_pending alone: the hub spawns this server
+        # right after the build returns, and setting/clearing the flag from a
+        # background task would clobber the pending state the hub relies on
+        try:
+            await spawner.poll_and_notify()
+        except Exception as e:
+            app_log.warning('Error polling existing spawner: %s', e)
+
     async def prespawn_server_options(self, dashboard, dashboard_user, ns):
         return {} # Empty options - override in subclasses if needed
 
@@ -1,16 +1,24 @@
 
 import asyncio
 
+from sqlalchemy.orm import joinedload
 from tornado.web import authenticated, HTTPError
-from async_generator import aclosing
 
 from jupyterhub.apihandlers.users import SpawnProgressAPIHandler
-from jupyterhub.utils import iterate_until
 
 from ..orm import Dashboard
 from ..util import url_path_join
 from ..app import BuildersStore
 
+# Keys a builder progress event is allowed to pass through to the client -
+# notably excludes 'ready', which only the handler itself may set
+_ALLOWED_PROGRESS_KEYS = frozenset({'progress', 'message', 'html_message', 'url', 'failed'})
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError: # Python 3.6
+    _current_task = asyncio.Task.current_task
+
 
 class ProgressDashboardHandler(SpawnProgressAPIHandler):
 
@@ -20,7 +28,12 @@ class ProgressDashboardHandler(SpawnProgressAPIHandler):
 
         current_user = await self.get_current_user()
 
-        dashboard = self.db.query(Dashboard).filter(Dashboard.urlname==dashboard_urlname).one_or_none()
+        # Eagerly load the owner and final spawner in the same SELECT - both are
+        # touched below (is_orm_user_allowed, ready_event), and progress
+        # connections reconnect on every SSE keepalive
+        dashboard = self.db.query(Dashboard).options(
+            joinedload(Dashboard.user), joinedload(Dashboard.final_spawner)
+        ).filter(Dashboard.urlname==dashboard_urlname).one_or_none()
 
         if dashboard is None:
             raise HTTPError(404, 'No such dashboard or user')
@@ -30,87 +43,119 @@ class ProgressDashboardHandler(SpawnProgressAPIHandler):
         
 
         # start sending keepalive to avoid proxies closing the connection
-        asyncio.ensure_future(self.keepalive())
-        # cases:
-        # - spawner already started and ready
-        # - spawner not running at all
-        # - spawner failed
-        # - spawner pending start (what we expect)
-        def ready_event(dashboard):
-            url = url_path_join(self.settings['base_url'], "user", dashboard.user.name, dashboard.final_spawner.name)
-            return {
-                'progress': 100,
-                'ready': True,
-                'message': "Redirecting to server at {}".format(url),
-                'html_message': 'Redirecting to server at <a href="{0}" target="_blank">{0}</a>'.format(url),
-                'url': url,
-            }
-
-        failed_event = {'progress': 100, 'failed': True, 'message': "Build failed or unable to get progress", 
-            'url': url_path_join(self.settings['base_url'], "hub", "dashboards", dashboard.urlname, 'clear-error')
-            }
-
-
-        builders_store = BuildersStore.get_instance(self.settings['config'])
-
-        builder = builders_store[dashboard]
-
-        if builder.ready:
-            # spawner already ready. Trigger progress-completion immediately
-            self.log.info("Server %s is already started", builder._log_name)
-            await self.send_event(ready_event(dashboard))
-            return
-
-        build_future = builder._build_future
-
-        if not builder._build_pending:
-            # not pending, no progress to fetch
-            # check if spawner has just failed
-            f = build_future
-            if f and f.done() and f.exception():
-                failed_event['message'] = "Build failed: %s" % f.exception()
-                await self.send_event(failed_event)
+        # keep hold of the keepalive and request tasks so they can be
+        # cancelled when the request ends or the client disconnects, rather
+        # than looping against a dead stream until the build resolves
+        self._request_task = _current_task()
+        self._keepalive_task = keepalive_task = asyncio.ensure_future(self.keepalive())
+        try:
+            # cases:
+            # - spawner already started and ready
+            # - spawner not running at all
+            # - spawner failed
+            # - spawner pending start (what we expect)
+            def ready_event(dashboard):
+                url = url_path_join(self.settings['base_url'], "user", dashboard.user.name, dashboard.final_spawner.name)
+                return {
+                    'progress': 100,
+                    'ready': True,
+                    'message': "Redirecting to server at {}".format(url),
+                    'html_message': 'Redirecting to server at <a href="{0}" target="_blank">{0}</a>'.format(url),
+                    'url': url,
+                }
+
+            def failed_event(message="Build failed or unable to get progress"):
+                return {'progress': 100, 'failed': True, 'message': message,
+                    'url': url_path_join(self.settings['base_url'], "hub", "dashboards", dashboard.urlname, 'clear-error')
+                    }
+
+
+            builders_store = BuildersStore.get_instance(self.settings['config'])
+
+            builder = builders_store[dashboard]
+
+            if builder.ready:
+                # spawner already ready. Trigger progress-completion immediately
+                self.log.info("Server %s is already started", builder._log_name)
+                await self.send_event(ready_event(dashboard))
                 return
-            else:
-                raise HTTPError(400, "%s is not starting...", builder._log_name)
-
-        if build_future: # Just in case build_future is None so iterate_until's asyncio.wait doesn't fail; 
-            # builder._generate_progress should return an iterator because _build_pending was non-None
-            # just above, with no awaits since
 
-            # Retrieve progress events from the Builder
-            async with aclosing(
-                iterate_until(build_future, builder._generate_progress())
-            ) as events:
+            build_future = builder._build_future
+
+            if not builder._build_pending:
+                # not pending, no progress to fetch
+                # check if spawner has just failed
+                f = build_future
+                if f and f.done() and f.exception():
+                    await self.send_event(failed_event("Build failed: %s" % f.exception()))
+                    return
+                else:
+                    raise HTTPError(400, "%s is not starting...", builder._log_name)
+
+            if build_future:
+                # builder._generate_progress should return an iterator because _build_pending was non-None
+                # just above, with no awaits since
+
+                # Retrieve progress events from the Builder, iterating the
+                # generator directly rather than through iterate_until, which
+                # adds a wrapper task and a future-poll per event
+                progress_gen = builder._generate_progress()
                 try:
-                    async for event in events:
-                        # don't allow events to sneakily set the 'ready' flag
-                        if 'ready' in event:
-                            event.pop('ready', None)
-                        await self.send_event(event)
+                    async for event in progress_gen:
+                        # don't allow events to sneakily set the 'ready' flag -
+                        # copy through the allowed keys rather than mutating the
+                        # builder's own event dict in place
+                        await self.send_event({k: v for k, v in event.items() if k in _ALLOWED_PROGRESS_KEYS})
+                        if build_future.done():
+                            break
                 except asyncio.CancelledError:
-                    pass
-
-            # progress finished, wait for spawn to actually resolve,
-            # in case progress finished early
-            # (ignore errors, which will be logged elsewhere)
-            await build_future
-
-        # progress and spawn finished, check if spawn succeeded
-        if builder.ready:
-            # spawner is ready, signal completion and redirect
-            self.log.info("Server %s is ready", builder._log_name)
-            await self.send_event(ready_event(dashboard))
-        else:
-            # what happened? Maybe spawn failed?
-            f = build_future
-            if f and f.done() and f.exception():
-                failed_event['message'] = "Build failed: %s" % f.exception()
+                    # client disconnected - stop streaming rather than
+                    # waiting out the rest of the build
+                    return
+                finally:
+                    await progress_gen.aclose()
+
+                # progress finished, wait for spawn to actually resolve,
+                # in case progress finished early
+                # (ignore errors, which will be logged elsewhere)
+                await build_future
+
+            # progress and spawn finished, check if spawn succeeded
+            if builder.ready:
+                # spawner is ready, signal completion and redirect
+                self.log.info("Server %s is ready", builder._log_name)
+                await self.send_event(ready_event(dashboard))
             else:
-                self.log.warning(
-                    "Server %s didn't start for unknown reason", builder._log_name
-                )
-            await self.send_event(failed_event)
+                # what happened? Maybe spawn failed?
+                f = build_future
+                if f and f.done() and f.exception():
+                    event = failed_event("Build failed: %s" % f.exception())
+                else:
+                    self.log.warning(
+                        "Server %s didn't start for unknown reason", builder._log_name
+                    )
+                    event = failed_event()
+                await self.send_event(event)
+        finally:
+            self._request_task = None
+            keepalive_task.cancel()
+            try:
+                await keepalive_task
+            except asyncio.CancelledError:
+                pass
+
+    _keepalive_task = None
+    _request_task = None
+
+    def on_connection_close(self):
+        # browser went away - stop the keepalive coroutine and any in-flight
+        # progress streaming rather than leaving them polling the builder and
+        # holding the handler and its db session until the build resolves
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
+        if self._request_task is not None:
+            self._request_task.cancel()
+        super().on_connection_close()
 
 
 
@@ -411,7 +411,7 @@ class MainViewDashboardHandler(DashboardBaseHandler):
         if not dashboard.is_orm_user_allowed(current_user.orm_user):
             return self.send_error(403)
 
-        dashboard_user = self._user_from_orm(dashboard.user.name)
+        dashboard_user = self._user_from_orm(dashboard.user)
 
         need_follow_progress = await self.maybe_start_build(dashboard, dashboard_user)
 
@@ -13,10 +13,10 @@ class SameUserSpawner(LocalProcessSpawner):
         path = '/Users/dan/Dev/cdsdashboards/examples/local_process_folder/%s' % self.user.name
 
         try:
-            os.mkdir(path)
+            os.makedirs(path, exist_ok=True)
         except OSError:
             print('Failed to create directory: %s' % path)
-       
+
         return env
 
     def _notebook_dir_default(self):
@@ -16,6 +16,9 @@ install_requires = [
 ]
 
 extras_require = {
+    'docker': [
+        'aiodocker>=0.18' # For DockerBuilder - no longer assumed to arrive with DockerSpawner
+    ],
     'user': [
         'jhsingle-native-proxy>=0.5.6',
         'plotlydash-tornado-cmd>=0.0.4',